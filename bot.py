@@ -3,16 +3,24 @@ import io
 import re
 import asyncio
 import sqlite3
-from datetime import datetime, timezone
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass
+from datetime import date
+from typing import TYPE_CHECKING
 
 from dotenv import load_dotenv
 
-from aiogram import Bot, Dispatcher, F
+from aiogram import BaseMiddleware, Bot, Dispatcher, F
 from aiogram.types import Message, BufferedInputFile
 from aiogram.filters import Command
+from aiogram.dispatcher.flags import get_flag
 
-import fitz  # PyMuPDF
-from docx import Document
+# PyMuPDF and python-docx are heavy and only needed once a PDF arrives,
+# so they are imported on first use rather than at startup.
+if TYPE_CHECKING:
+    import fitz  # PyMuPDF
 
 
 # =========================
@@ -32,6 +40,9 @@ CHANNEL_LINK = os.getenv("CHANNEL_LINK", "https://t.me/ConvertPDFtotext").strip(
 
 DB_PATH = os.getenv("DB_PATH", "data.db").strip()
 
+# Telegram's Bot API refuses to serve files above 20 MB to bots.
+MAX_FILE_BYTES = int(os.getenv("MAX_FILE_MB", "20")) * 1024 * 1024
+
 # =========================
 # PLANS (match your BMC tiers)
 # FREE: 10 pages/day
@@ -53,85 +64,250 @@ DOCX_PLANS = {"PREMIUM"}
 # =========================
 # DB Helpers
 # =========================
-def db() -> sqlite3.Connection:
-    conn = sqlite3.connect(DB_PATH)
-    conn.execute("PRAGMA journal_mode=WAL;")
-    return conn
+# One process-wide connection: the bot is a single process and every helper
+# runs on the event loop thread, so statements are already serialized.
+# Autocommit mode (isolation_level=None) commits each statement as it runs.
+CONN = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None)
+CONN.executescript(
+    """
+    PRAGMA journal_mode=WAL;
+    PRAGMA synchronous=NORMAL;
+    PRAGMA temp_store=MEMORY;
+    PRAGMA busy_timeout=5000;
+    PRAGMA mmap_size=67108864;
+    PRAGMA cache_size=-8192;
+    PRAGMA wal_autocheckpoint=1000;
+    """
+)
+
+
+@contextmanager
+def txn():
+    """
+    Runs the enclosed statements as one write transaction (one commit).
+    """
+    CONN.execute("BEGIN IMMEDIATE")
+    try:
+        yield CONN
+        CONN.execute("COMMIT")
+    except BaseException:
+        # SQLite may already have rolled back on its own (e.g. after an I/O error).
+        if CONN.in_transaction:
+            CONN.execute("ROLLBACK")
+        raise
+
+
+USAGE_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS {name} (
+        user_id INTEGER NOT NULL,
+        day INTEGER NOT NULL,
+        pages_used INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY(user_id, day)
+    ) WITHOUT ROWID
+"""
 
 
 def init_db() -> None:
-    with db() as conn:
-        conn.execute(
-            """
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                plan TEXT NOT NULL DEFAULT 'FREE'
-            )
-            """
+    CONN.execute(
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            plan TEXT NOT NULL DEFAULT 'FREE'
         )
-        conn.execute(
-            """
-            CREATE TABLE IF NOT EXISTS usage (
-                user_id INTEGER NOT NULL,
-                day TEXT NOT NULL,
-                pages_used INTEGER NOT NULL DEFAULT 0,
-                PRIMARY KEY(user_id, day)
+        """
+    )
+    CONN.execute(USAGE_TABLE_SQL.format(name="usage"))
+    migrate_usage_table()
+
+
+def migrate_usage_table() -> None:
+    """
+    Rebuilds a `usage` table created by older versions (rowid storage
+    and/or "YYYY-MM-DD" TEXT days) into the current layout.
+    """
+    table_sql = CONN.execute(
+        "SELECT sql FROM sqlite_master WHERE type='table' AND name='usage'"
+    ).fetchone()[0]
+    day_type = CONN.execute(
+        "SELECT type FROM pragma_table_info('usage') WHERE name='day'"
+    ).fetchone()[0]
+    if "WITHOUT ROWID" in table_sql.upper() and day_type.upper() == "INTEGER":
+        return
+    with txn():
+        CONN.execute(USAGE_TABLE_SQL.format(name="usage_new"))
+        if day_type.upper() == "INTEGER":
+            CONN.execute(
+                "INSERT INTO usage_new(user_id, day, pages_used) "
+                "SELECT user_id, day, pages_used FROM usage"
             )
-            """
-        )
+        else:
+            CONN.execute(
+                "INSERT INTO usage_new(user_id, day, pages_used) "
+                "SELECT user_id, CAST(julianday(day) - julianday(?) AS INTEGER), pages_used FROM usage",
+                (DAY_EPOCH.isoformat(),),
+            )
+        CONN.execute("DROP TABLE usage")
+        CONN.execute("ALTER TABLE usage_new RENAME TO usage")
 
 
-def today_utc_str() -> str:
-    return datetime.now(timezone.utc).strftime("%Y-%m-%d")
+# =========================
+# In-process caches
+# Plans change only via /setplan, usage only via add_usage_today, and both
+# invalidate their entry, so TTLs only bound staleness from writes made
+# outside this process. Usage is keyed by (user_id, day).
+# =========================
+PLAN_CACHE_TTL = 60
+USAGE_CACHE_TTL = 5
+CACHE_MAX_ENTRIES = 10_000
 
+_plan_cache: dict[int, tuple[str, float]] = {}
+_usage_cache: dict[tuple[int, int], tuple[int, float]] = {}
 
-def ensure_user(user_id: int) -> None:
-    with db() as conn:
-        conn.execute(
-            "INSERT OR IGNORE INTO users(user_id, plan) VALUES (?, 'FREE')",
-            (user_id,),
-        )
+# Users already registered by this process; lets ensure_user skip the INSERT.
+KNOWN_USERS_MAX = 100_000
+_known_users: set[int] = set()
 
 
-def get_user_plan(user_id: int) -> str:
-    ensure_user(user_id)
-    with db() as conn:
-        row = conn.execute("SELECT plan FROM users WHERE user_id=?", (user_id,)).fetchone()
-    return (row[0] if row else "FREE").upper()
+def _cache_get(cache: dict, key):
+    hit = cache.get(key)
+    if hit is None:
+        return None
+    value, expires_at = hit
+    if expires_at <= time.monotonic():
+        cache.pop(key, None)
+        return None
+    return value
+
+
+def _cache_put(cache: dict, key, value, ttl: float) -> None:
+    now = time.monotonic()
+    if len(cache) >= CACHE_MAX_ENTRIES and key not in cache:
+        # Sweep expired entries first, then fall back to dropping the oldest.
+        for k in [k for k, (_, exp) in cache.items() if exp <= now]:
+            del cache[k]
+        if len(cache) >= CACHE_MAX_ENTRIES:
+            cache.pop(next(iter(cache)))
+    cache[key] = (value, now + ttl)
+
+
+# usage.day is stored as whole UTC days since DAY_EPOCH.
+DAY_EPOCH = date(2024, 1, 1)
+_DAY_EPOCH_OFFSET = (DAY_EPOCH - date(1970, 1, 1)).days
+
+
+def today_int() -> int:
+    return int(time.time() // 86400) - _DAY_EPOCH_OFFSET
+
+
+def ensure_user(user_id: int) -> None:
+    if user_id in _known_users:
+        return
+    CONN.execute(
+        "INSERT OR IGNORE INTO users(user_id, plan) VALUES (?, 'FREE')",
+        (user_id,),
+    )
+    if len(_known_users) >= KNOWN_USERS_MAX:
+        _known_users.pop()
+    _known_users.add(user_id)
 
 
 def set_user_plan(user_id: int, plan: str) -> None:
     plan = plan.upper().strip()
     if plan not in PLANS:
         raise ValueError("Invalid plan")
-    ensure_user(user_id)
-    with db() as conn:
-        conn.execute("UPDATE users SET plan=? WHERE user_id=?", (plan, user_id))
+    CONN.execute(
+        """
+        INSERT INTO users(user_id, plan) VALUES (?, ?)
+        ON CONFLICT(user_id) DO UPDATE SET plan = excluded.plan
+        """,
+        (user_id, plan),
+    )
+    _plan_cache.pop(user_id, None)
+
+
+def get_usage_today(user_id: int, day: int | None = None) -> int:
+    if day is None:
+        day = today_int()
+    used = _cache_get(_usage_cache, (user_id, day))
+    if used is not None:
+        return used
+    row = CONN.execute(
+        "SELECT pages_used FROM usage WHERE user_id=? AND day=?",
+        (user_id, day),
+    ).fetchone()
+    used = int(row[0]) if row else 0
+    _cache_put(_usage_cache, (user_id, day), used, USAGE_CACHE_TTL)
+    return used
+
+
+def add_usage_today(user_id: int, pages: int, day: int | None = None) -> None:
+    if day is None:
+        day = today_int()
+    CONN.execute(
+        """
+        INSERT INTO usage(user_id, day, pages_used)
+        VALUES (?, ?, ?)
+        ON CONFLICT(user_id, day) DO UPDATE SET pages_used = pages_used + excluded.pages_used
+        """,
+        (user_id, day, int(pages)),
+    )
+    _usage_cache.pop((user_id, day), None)
 
 
-def get_usage_today(user_id: int) -> int:
+def get_plan_and_usage(user_id: int, day: int) -> tuple[str, int]:
+    """
+    Returns: (plan, pages_used_on_day) in a single query
+    """
+    row = CONN.execute(
+        """
+        SELECT u.plan, COALESCE(us.pages_used, 0)
+        FROM users u
+        LEFT JOIN usage us ON us.user_id = u.user_id AND us.day = ?
+        WHERE u.user_id = ?
+        """,
+        (day, user_id),
+    ).fetchone()
+    if not row:
+        return "FREE", get_usage_today(user_id, day)
+    return row[0].upper(), int(row[1])
+
+
+@dataclass(slots=True)
+class UserState:
+    plan: str
+    limit: int
+    used_today: int
+    day: int
+
+
+def load_user_state(user_id: int, day: int | None = None, cached: bool = True) -> UserState:
+    """
+    Registers the user if needed and returns their plan and today's usage,
+    served from the in-process caches when both are warm (unless `cached`
+    is False, which always reads the DB).
+    """
+    if day is None:
+        day = today_int()
     ensure_user(user_id)
-    day = today_utc_str()
-    with db() as conn:
-        row = conn.execute(
-            "SELECT pages_used FROM usage WHERE user_id=? AND day=?",
-            (user_id, day),
-        ).fetchone()
-    return int(row[0]) if row else 0
+    plan = _cache_get(_plan_cache, user_id) if cached else None
+    used = _cache_get(_usage_cache, (user_id, day)) if cached else None
+    if plan is None or used is None:
+        plan, used = get_plan_and_usage(user_id, day)
+        _cache_put(_plan_cache, user_id, plan, PLAN_CACHE_TTL)
+        _cache_put(_usage_cache, (user_id, day), used, USAGE_CACHE_TTL)
+    return UserState(plan, PLANS.get(plan, PLANS["FREE"]), used, day)
 
 
-def add_usage_today(user_id: int, pages: int) -> None:
-    ensure_user(user_id)
-    day = today_utc_str()
-    with db() as conn:
-        conn.execute(
-            """
-            INSERT INTO usage(user_id, day, pages_used)
-            VALUES (?, ?, ?)
-            ON CONFLICT(user_id, day) DO UPDATE SET pages_used = pages_used + excluded.pages_used
-            """,
-            (user_id, day, int(pages)),
-        )
+class UserStateMiddleware(BaseMiddleware):
+    """
+    Injects the sender's UserState as `user_state` into handlers registered
+    with flags={"user_state": True}.
+    """
+
+    async def __call__(self, handler, event: Message, data: dict):
+        if get_flag(data, "user_state"):
+            data["user_state"] = load_user_state(event.from_user.id)
+        return await handler(event, data)
 
 
 # =========================
@@ -166,10 +342,13 @@ def upgrade_text() -> str:
     return "\n".join(lines)
 
 
-def plan_text(user_id: int) -> str:
-    plan = get_user_plan(user_id)
-    used = get_usage_today(user_id)
-    limit = PLANS.get(plan, PLANS["FREE"])
+# Both depend only on env-fixed links, so build them once.
+HELP_TEXT = help_text()
+UPGRADE_TEXT = upgrade_text()
+
+
+def plan_text(user_state: UserState) -> str:
+    plan = user_state.plan
     extra = ""
     if plan in DOCX_PLANS:
         extra = "\nDOCX export: ✅ Enabled"
@@ -177,36 +356,85 @@ def plan_text(user_id: int) -> str:
         extra = "\nDOCX export: ❌ Premium only"
     return (
         f"📊 Your Plan: {plan}\n"
-        f"Daily Limit: {limit} pages\n"
-        f"Used Today: {used} pages\n"
+        f"Daily Limit: {user_state.limit} pages\n"
+        f"Used Today: {user_state.used_today} pages\n"
         f"Use /upgrade to unlock higher limits.\n"
         f"{extra}"
     )
 
 
+def limit_reached_text(user_state: UserState) -> str:
+    remaining = max(0, user_state.limit - user_state.used_today)
+    return (
+        f"⚠️ Daily limit reached.\n"
+        f"Plan: {user_state.plan}\n"
+        f"Remaining today: {remaining} pages\n\n"
+        f"Use /upgrade to unlock higher limits."
+    )
+
+
 # =========================
 # PDF Conversion
 # =========================
-def extract_text_from_pdf(pdf_bytes: bytes) -> tuple[str, int]:
+# PyMuPDF has no multithreading support, even across separate documents, so
+# every fitz call goes through this one thread. That keeps the event loop
+# free without ever running MuPDF in parallel.
+_pdf_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="pymupdf")
+
+
+async def run_pdf(func, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_pdf_executor, func, *args)
+
+
+def _page_texts(doc: "fitz.Document") -> list[str]:
+    import fitz  # PyMuPDF
+
+    # Plain-text flags without image collection, pinned so extraction
+    # output doesn't drift with PyMuPDF's defaults.
+    flags = fitz.TEXTFLAGS_TEXT & ~fitz.TEXT_PRESERVE_IMAGES
+    return [doc.load_page(i).get_text("text", flags=flags) for i in range(doc.page_count)]
+
+
+def open_pdf(pdf_stream: io.BytesIO) -> tuple["fitz.Document", int]:
+    """
+    Returns: (doc, page_count)
+    """
+    import fitz  # PyMuPDF
+
+    doc = fitz.open(stream=pdf_stream, filetype="pdf")
+    return doc, doc.page_count
+
+
+def _close_opened_pdf(fut: asyncio.Future) -> None:
+    # Done-callback for an open_pdf() whose caller was cancelled meanwhile.
+    if not fut.cancelled() and fut.exception() is None:
+        _pdf_executor.submit(fut.result()[0].close)
+
+
+def extract_text_from_pdf(doc: "fitz.Document") -> tuple[str, list[str]]:
     """
-    Returns: (text, page_count)
+    Returns: (text, per_page_texts)
     """
-    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
-    page_count = doc.page_count
-    parts = []
-    for i in range(page_count):
-        page = doc.load_page(i)
-        parts.append(page.get_text("text"))
-    doc.close()
-    text = "\n".join(parts).strip()
-    return text, page_count
-
-
-def build_docx_bytes(text: str) -> bytes:
+    # PyMuPDF has no multithreading support and get_text() holds the GIL,
+    # so pages are extracted in one pass on a single thread.
+    parts = _page_texts(doc)
+    return "\n".join(parts).strip(), parts
+
+
+_PARA_RE = re.compile(r"\n\s*\n")
+
+
+def build_docx_bytes(pages: list[str]) -> bytes:
+    from docx import Document
+
     d = Document()
-    # Split into paragraphs
-    for para in re.split(r"\n\s*\n", text.strip() or ""):
-        d.add_paragraph(para.strip())
+    for i, page_text in enumerate(pages):
+        if i:
+            d.add_page_break()
+        # Split into paragraphs
+        for para in _PARA_RE.split(page_text.strip()):
+            d.add_paragraph(para.strip())
     bio = io.BytesIO()
     d.save(bio)
     return bio.getvalue()
@@ -217,6 +445,7 @@ def build_docx_bytes(text: str) -> bytes:
 # =========================
 bot = Bot(token=BOT_TOKEN)
 dp = Dispatcher()
+dp.message.middleware(UserStateMiddleware())
 
 
 @dp.message(Command("start"))
@@ -230,12 +459,12 @@ async def start_cmd(message: Message):
 
 @dp.message(Command("help"))
 async def help_cmd(message: Message):
-    await message.answer(help_text())
+    await message.answer(HELP_TEXT)
 
 
 @dp.message(Command("upgrade"))
 async def upgrade_cmd(message: Message):
-    await message.answer(upgrade_text())
+    await message.answer(UPGRADE_TEXT)
 
 
 @dp.message(Command("id"))
@@ -247,10 +476,9 @@ async def id_cmd(message: Message):
     )
 
 
-@dp.message(Command("plan"))
-async def plan_cmd(message: Message):
-    user_id = message.from_user.id
-    await message.answer(plan_text(user_id))
+@dp.message(Command("plan"), flags={"user_state": True})
+async def plan_cmd(message: Message, user_state: UserState):
+    await message.answer(plan_text(user_state))
 
 
 @dp.message(Command("setplan"))
@@ -279,60 +507,81 @@ async def setplan_cmd(message: Message):
 @dp.message(F.document)
 async def handle_document(message: Message):
     user_id = message.from_user.id
-    ensure_user(user_id)
-
     doc = message.document
     filename = (doc.file_name or "").lower()
 
     if not filename.endswith(".pdf"):
         return await message.answer("Please send a PDF file (.pdf).")
 
+    if doc.file_size and doc.file_size > MAX_FILE_BYTES:
+        return await message.answer(
+            f"This file is too large. Maximum size is {MAX_FILE_BYTES // (1024 * 1024)} MB."
+        )
+
+    # Nothing to do for users who have already used up today's pages
+    user_state = load_user_state(user_id)
+    if user_state.used_today >= user_state.limit:
+        return await message.answer(limit_reached_text(user_state))
+
     # Download file
     tg_file = await bot.get_file(doc.file_id)
-    file_bytes = await bot.download_file(tg_file.file_path)
-    pdf_bytes = file_bytes.read()
+    pdf_stream = await bot.download_file(tg_file.file_path)
 
-    # Convert
+    # Shielded so that a cancellation mid-open still gets the document closed.
+    opening = asyncio.get_running_loop().run_in_executor(_pdf_executor, open_pdf, pdf_stream)
     try:
-        text, pages = extract_text_from_pdf(pdf_bytes)
+        pdf, pages = await asyncio.shield(opening)
+    except asyncio.CancelledError:
+        opening.add_done_callback(_close_opened_pdf)
+        raise
     except Exception:
         return await message.answer("Failed to read this PDF. Please try another file.")
 
-    # Check limit
-    plan = get_user_plan(user_id)
-    limit = PLANS.get(plan, PLANS["FREE"])
-    used = get_usage_today(user_id)
-
-    if used + pages > limit:
-        remaining = max(0, limit - used)
-        return await message.answer(
-            f"⚠️ Daily limit reached.\n"
-            f"Plan: {plan}\n"
-            f"Remaining today: {remaining} pages\n\n"
-            f"Use /upgrade to unlock higher limits."
-        )
-
-    # Count usage
-    add_usage_today(user_id, pages)
+    try:
+        # Check limit before spending any time on extraction. Usage is read
+        # from the DB and counted inside one BEGIN IMMEDIATE transaction, so
+        # concurrent uploads can't both pass the check; it is given back if
+        # extraction fails or is cancelled.
+        with txn():
+            user_state = load_user_state(user_id, cached=False)
+            allowed = user_state.used_today + pages <= user_state.limit
+            if allowed:
+                add_usage_today(user_id, pages, user_state.day)
+
+        if not allowed:
+            return await message.answer(limit_reached_text(user_state))
+
+        # Convert
+        try:
+            text, page_texts = await run_pdf(extract_text_from_pdf, pdf)
+        except asyncio.CancelledError:
+            add_usage_today(user_id, -pages, user_state.day)
+            raise
+        except Exception:
+            add_usage_today(user_id, -pages, user_state.day)
+            return await message.answer("Failed to read this PDF. Please try another file.")
+    finally:
+        # Queued behind any extraction still running on the single PDF thread.
+        _pdf_executor.submit(pdf.close)
 
     # Build TXT
     txt_bytes = (text or "").encode("utf-8", errors="replace")
     txt_file = BufferedInputFile(txt_bytes, filename="converted.txt")
 
     # Send TXT
-    used_after = get_usage_today(user_id)
+    used_after = user_state.used_today + pages
     await message.answer_document(
         txt_file,
         caption=(
             f"✅ Converted successfully.\n"
-            f"Pages used today: {used_after}/{limit}"
+            f"Pages used today: {used_after}/{user_state.limit}"
         ),
     )
 
     # Optional DOCX for PREMIUM only
-    if plan in DOCX_PLANS:
+    if user_state.plan in DOCX_PLANS:
         try:
-            docx_bytes = build_docx_bytes(text or "")
+            docx_bytes = await asyncio.to_thread(build_docx_bytes, page_texts)
             docx_file = BufferedInputFile(docx_bytes, filename="converted.docx")
             await message.answer_document(docx_file, caption="📄 DOCX export (Premium).")
         except Exception: